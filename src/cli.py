@@ -1,62 +1,141 @@
 #!/usr/bin/env python3
 
 import argparse
-import collections
+import asyncio
+import contextlib
 from datetime import datetime
-import queue
-import threading
+import itertools
+import json
+import logging
+import os
+import stat
+import sys
+import tempfile
 import time
 from . import execute
 
 
-def _get_locked(lock, data, key):
-    ''' Access data[key] while holding lock '''
-    with lock:  # lock while obtaining key-specific data
-        return data[key]
-
-
-def _wait_to_start(wait_secs, host, data_lock, lock_data):
+async def _wait_to_start(wait_secs, host_id, host_info):
     ''' Wait some time to ensure host-jobs are not started more frequently than every wait_secs sec(s). '''
     if not wait_secs:
-        return  # skip lock interactions entirely.
-    with _get_locked(data_lock, lock_data, host):
-        time.sleep(wait_secs)
+        return  # skip bookkeeping entirely.
+    # Reserve the next free start slot of host. No need for a lock, as there is no await until the slot is taken.
+    _, next_start = host_info[host_id]
+    now = time.monotonic()
+    delay = max(0.0, next_start[0] - now)
+    next_start[0] = now + delay + wait_secs
+    await asyncio.sleep(delay)
+
+
+class JobResult:
+    ''' Outcome of a single job, as reported by workers. '''
+    __slots__ = ('job_id', 'job', 'return_code', 'console', 'host', 'start_date', 'finish_date')
+
+    def __init__(self, job_id, job, return_code, console, host, start_date, finish_date):
+        self.job_id = job_id
+        self.job = job
+        self.return_code = return_code
+        self.console = console
+        self.host = host
+        self.start_date = start_date
+        self.finish_date = finish_date
+
+    @property
+    def wall_time(self):
+        return self.finish_date - self.start_date
 
 
 #
-# Function run by worker processes
+# Coroutine run by workers
 #
-def worker(host, setup_details, in_queue, out_queue):
-    for job_id, job in iter(in_queue.get, 'STOP'):
+async def worker(host_id, setup_details, batch_size, batch_delay, in_queue, out_queue):
+    host, _ = setup_details['host_info'][host_id]
+    # Jobs are shell commands, run by a local shell or the login shell of host
+    cmd_prefix = ['sh', '-c'] if _is_local(host) and '@' not in host else execute.ssh_prefix(host)
+    results = []
+    deliver_later = None  # Handle to deliver results no later than batch_delay secs after the oldest one
+
+    def deliver():
+        nonlocal results, deliver_later
+        if deliver_later is not None:
+            deliver_later.cancel()
+            deliver_later = None
+        if results:
+            out_queue.put_nowait(results)
+            results = []
+
+    while True:
+        # Deliver results in batches, but never keep any back while waiting for more jobs.
+        if len(results) >= batch_size or in_queue.empty():
+            deliver()
+
+        job_id, job = await in_queue.get()
+
         # Wait some time to ensure host-jobs are not started too frequently.
-        _wait_to_start(host=host, **setup_details)
+        await _wait_to_start(host_id=host_id, **setup_details)
         start_date = datetime.now()
 
         # Execute job
-        return_code, console = utils.execute.execute(job)
+        return_code, console = await execute.execute(cmd_prefix + [job])
 
-        # Write result to out_queue
+        # Collect result for out_queue
         finish_date = datetime.now()
-        out_queue.put({
-            'job_id': job_id,
-            'job': job,
-            'return_code': return_code,
-            'console': console,
-            'host': host,
-            'start_date': start_date,
-            'finish_date': finish_date,
-            'wall_time': finish_date - start_date,
-        })
-
-
-def report(job, job_id, return_code, host, wall_time, start_date, finish_date, console, suppress_console, **kwargs):
-    prefix = '[{:d}]'.format(job_id)
-    print(prefix, 'Job:        ', job)
-    print(prefix, 'Return Code:', return_code)
-    print(prefix, 'Host:       ', host)
-    print(prefix, 'Wall Time:  ', wall_time, '(From {s} until {f})'.format(s=start_date, f=finish_date))
+        results.append(JobResult(job_id, job, return_code, console, host, start_date, finish_date))
+        if deliver_later is None:
+            deliver_later = asyncio.get_running_loop().call_later(batch_delay, deliver)
+
+
+def _format_report(result, suppress_console):
+    prefix = '[{:d}]'.format(result.job_id)
+    fields = [
+        (prefix, 'Job:        ', result.job),
+        (prefix, 'Return Code:', result.return_code),
+        (prefix, 'Host:       ', result.host),
+        (prefix, 'Wall Time:  ', result.wall_time,
+         '(From {s} until {f})'.format(s=result.start_date, f=result.finish_date)),
+    ]
     if not suppress_console:
-        print(prefix, 'Log: ', *console)
+        fields.append((prefix, 'Log: ', *result.console))
+    return ''.join(' '.join(str(f) for f in line_fields) + '\n' for line_fields in fields)
+
+
+def report(result, suppress_console):
+    # In one go, such that reports are not torn apart by job output
+    sys.stdout.write(_format_report(result, suppress_console))
+
+
+def _is_local(host):
+    ''' Whether host (optionally with user) refers to the local machine. '''
+    return host.rpartition('@')[2] in ('', 'localhost', '127.0.0.1')
+
+
+async def _query_num_cores(host):
+    ''' Number of cores available on (remote) host; 1 if unknown. '''
+    # Never prompt (eg. for passwords) nor wait for unreachable hosts
+    cmd = execute.ssh_prefix(host, '-o', 'BatchMode=yes', '-o', 'ConnectTimeout=10') + ['nproc']
+    return_code, console = await execute.execute(cmd, timeout=30)
+    if return_code != 0 or not console or not console[0].strip().isdigit():
+        logging.warning('Failed to query number of cores on %s; using a single thread.', host)
+        return 1
+    return max(1, int(console[0]))
+
+
+async def _resolve_num_threads(work_hosts, max_local):
+    ''' Replace unspecified numbers of threads in work_hosts and cap the total number of local threads. '''
+    unknown = list({host: None for host, num in work_hosts if num is None})  # hosts in order, without duplicates
+    num_cores = dict(zip(unknown, await asyncio.gather(*map(_query_num_cores, unknown))))
+
+    resolved = []
+    for host, num in work_hosts:
+        if num is None:
+            num = num_cores[host]
+        if max_local is not None and _is_local(host):
+            num = min(num, max_local)
+            max_local -= num
+            if num < 1:
+                continue
+        resolved.append((host, num))
+    return resolved
 
 
 class _StoreHostDetails(argparse.Action):
@@ -79,8 +158,10 @@ class _StoreHostDetails(argparse.Action):
             if values[1] < 1:
                 parser.error('{d}; non-positive NUM_THREADS specified ({t}).'.format(d=base_description, t=values[1]))
             values = tuple(values)
+        elif _is_local(values[0]):  # len(values) == 1
+            values = (values[0], os.cpu_count() or 1)
         else:  # len(values) == 1
-            values = (values[0], 10)
+            values = (values[0], None)  # Determined by querying host, see _resolve_num_threads
         getattr(namespace, self.dest).append(values)
 
 
@@ -89,25 +170,31 @@ def main():
     parser_config = {
         # TODO: Host specification
         ('--jobfile', '-j'):
-            {'type': argparse.FileType('r'), 'help': 'Path to file containing all jobs.', 'required': True},
+            {'type': argparse.FileType('r'), 'help': 'Path to file containing all jobs. Required unless --serve.'},
         ('--host',):
             {'metavar': 'H', 'action': _StoreHostDetails, 'nargs': '+', 'default': [],
              'help': 'Add host H as worker for jobs.'},
         ('--suppress-console',): {'action': 'store_true', 'help': 'Suppress job output.'},
         ('--setup-pause',): {'type': float, 'help': 'Time to wait before starting a job in sec.'},
+        ('--max-local',): {'type': int, 'help': 'Max number of threads on localhost in total.'},
+        ('--batch-size',): {'type': int, 'help': 'Max number of results a worker reports at once (default: 16).'},
+        ('--batch-delay',): {'type': float, 'help': 'Max secs a result is held back for batching (default: 0.1).'},
+        ('--serve',): {'action': 'store_true', 'help': 'Keep running and execute jobs sent with --submit.'},
+        ('--submit',): {'action': 'store_true', 'help': 'Send jobs to a running --serve instance instead.'},
+        ('--socket',): {'help': 'Socket used by --serve and --submit (default: $XDG_RUNTIME_DIR/dojobs.sock).'},
         ('--list-arguments',): {'action': 'store_true', 'help': 'List allowed arguments (for auto-completion).'},
     }
     parser = argparse.ArgumentParser(
         description='Run jobs (remotely) in parallel.',
         formatter_class=argparse.RawTextHelpFormatter,
         epilog='''
-A job is a one-line bash-like command. The job will not be executed
-in a full shell, ie. with restricted features only. Output
-redirection will not work, while chaining with '&&' or ';' is
-supported.
+A job is a one-line shell command. On 'localhost' it is run by
+'sh -c', on any other host (including 'user@localhost') by the login
+shell of that host via ssh. Hence chaining with '&&' or ';' as well
+as output redirection are supported.
 
-A jobfile is a file containing one job in each line. Comments as well
-as empty lines are not supported.
+A jobfile is a file containing one job in each line. Empty lines are
+skipped, comments are not supported.
 
 Hosts are specified as '[user@]host [num_threads]'. This adds
 'num_threads' workers on given 'host' to execute jobs in parallel.
@@ -119,42 +206,261 @@ maximum number of cores available on 'host'.
         parser.add_argument(*options, **config)
 
     args = parser.parse_args()
+    if args.max_local is not None and args.max_local < 1:
+        parser.error('Non-positive --max-local specified ({m}).'.format(m=args.max_local))
+    if args.serve and args.submit:
+        parser.error('Only one of --serve and --submit may be specified.')
+    if args.serve == (args.jobfile is not None):
+        parser.error('A jobfile is required unless --serve is given (and not supported otherwise).')
+    if args.submit:
+        # Workers are set up by the --serve instance, hence these would have no effect.
+        unused = [o for o, v in (('--host', args.host), ('--max-local', args.max_local),
+                                 ('--batch-size', args.batch_size), ('--batch-delay', args.batch_delay),
+                                 ('--setup-pause', args.setup_pause)) if v not in (None, [])]
+        if unused:
+            parser.error('Not supported with --submit: {o}.'.format(o=', '.join(unused)))
+    if args.serve and args.suppress_console:
+        parser.error('Specify --suppress-console with --submit instead.')
+    if args.batch_size is None:
+        args.batch_size = 16
+    if args.batch_size < 1:
+        parser.error('Non-positive --batch-size specified ({b}).'.format(b=args.batch_size))
+    if args.batch_delay is None:
+        args.batch_delay = 0.1
+    if args.batch_delay < 0:
+        parser.error('Negative --batch-delay specified ({d}).'.format(d=args.batch_delay))
+    if (args.serve or args.submit) and args.socket is None:
+        args.socket = _default_socket_path()
+        if args.socket is None:
+            parser.error('No private default location for the socket; specify --socket.')
+
+    try:
+        if args.serve:
+            asyncio.run(_serve(args))
+        elif args.submit:
+            asyncio.run(_submit(args))
+        else:
+            asyncio.run(_run(args))
+    except KeyboardInterrupt:
+        if not args.serve:  # The usual way to stop --serve, but an abort otherwise
+            sys.exit(130)
+
+
+async def _read_jobs(jobfile):
+    ''' Iterate (lazily) over all jobs in jobfile, without surrounding whitespace and skipping empty lines. '''
+    if stat.S_ISREG(os.fstat(jobfile.fileno()).st_mode):  # Reading regular files does not block for long
+        for job in map(str.strip, jobfile):
+            if job:
+                yield job
+        return
 
+    # Pipes (eg. '-j -') may deliver jobs slowly, hence must not block the event loop while waiting for lines
+    lines = asyncio.StreamReader()
+    transport, _ = await asyncio.get_running_loop().connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(lines), jobfile)
+    try:
+        while True:
+            line = await lines.readline()
+            if not line:
+                break
+            job = line.decode().strip()
+            if job:
+                yield job
+    finally:
+        transport.close()
+
+
+async def _setup_workers(args):
+    ''' Create task and done queue as well as (not yet started) workers for all hosts of args. '''
     # TODO: Adjust specified numbers acc. to max number of free cores. Make adjusting default, add option to turn off.
-    # TODO: Add special handling for localhost, ie. execute right here, right now.
-    work_hosts = args.host
+    work_hosts = await _resolve_num_threads(args.host, args.max_local)
     num_processes = sum([x for (d, x) in work_hosts])
 
+    # Per host (indexed by host id) its name and the earliest time.monotonic() to start its next job.
+    host_ids = {}
+    host_info = []
+    for host, _ in work_hosts:
+        if host not in host_ids:
+            host_ids[host] = len(host_info)
+            host_info.append((host, [0.0]))
+
     setup_details = {
         'wait_secs': args.setup_pause,
-        'data_lock': threading.Lock(),
-        'lock_data': collections.defaultdict(threading.Lock)
+        'host_info': host_info,
     }
 
     # Create queues
-    task_queue = queue.Queue()
-    done_queue = queue.Queue()
+    task_queue = asyncio.Queue(maxsize=max(64, 4 * num_processes))  # bounded to not hold the entire jobfile
+    done_queue = asyncio.Queue()
 
-    # Submit tasks
-    for job_id, job in enumerate(args.jobfile):
-        job = job.strip()  # Remove trailing whitespace, in particular the potential '\n'.
-        task_queue.put((job_id, job))
-        num_jobs = job_id + 1  # Queue has no len, hence we have to keep track manually.
-
-    # Setup workers
     # TODO: Can be encapsulated in a with WorkerContext class?
-    for host, num in work_hosts:
-        for i in range(num):
-            threading.Thread(target=worker, args=(host, setup_details, task_queue, done_queue)).start()
+    workers = [worker(host_ids[host], setup_details, args.batch_size, args.batch_delay, task_queue, done_queue)
+               for host, num in work_hosts for i in range(num)]
+    return task_queue, done_queue, workers
+
+
+async def _run(args):
+    ''' Run all jobs of args.jobfile on a single event loop. '''
+    task_queue, done_queue, workers = await _setup_workers(args)
+
+    # Jobs still to be reported; increased on submission and decreased on reporting.
+    remaining = 0
+    submitted = asyncio.Event()
+
+    async def submit():
+        nonlocal remaining
+        job_id = 0
+        async for job in _read_jobs(args.jobfile):
+            await task_queue.put((job_id, job))  # Blocks while workers are behind.
+            job_id += 1
+            remaining += 1  # Queue has no len, hence we have to keep track manually.
+        submitted.set()
+        done_queue.put_nowait([])  # Wake up collect() in case everything was reported already.
+
+    async def collect():
+        nonlocal remaining
+        # Get and report results
+        while not submitted.is_set() or remaining > 0:
+            batch = await done_queue.get()
+            for result in batch:
+                report(result, args.suppress_console)
+            remaining -= len(batch)
+
+    # Setup workers before submitting, such that jobs are run while the jobfile is still read.
+    worker_tasks = [asyncio.ensure_future(w) for w in workers]
+    reporting = asyncio.gather(submit(), collect())
+    try:
+        # Workers never finish on their own, hence this only waits for all reports (or any failure).
+        done, _ = await asyncio.wait([reporting, *worker_tasks], return_when=asyncio.FIRST_COMPLETED)
+        for future in done:
+            future.result()  # raise failures
+    finally:
+        # Stop workers instead of telling them to; on failures this also kills jobs still running.
+        reporting.cancel()
+        for task in worker_tasks:
+            task.cancel()
+        await asyncio.gather(reporting, *worker_tasks, return_exceptions=True)
+
+
+def _default_socket_path():
+    ''' Socket used to connect --submit clients to a --serve server; None if there is no private place for it. '''
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if not runtime_dir:
+        # Fall back to a per-user directory, which must not be accessible (let alone be owned) by anyone else.
+        runtime_dir = os.path.join(tempfile.gettempdir(), 'dojobs-{u:d}'.format(u=os.getuid()))
+        try:
+            os.makedirs(runtime_dir, mode=0o700, exist_ok=True)
+            info = os.lstat(runtime_dir)
+        except OSError:  # eg. someone else put a file there
+            return None
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+            return None
+    return os.path.join(runtime_dir, 'dojobs.sock')
+
+
+async def _serve(args):
+    ''' Keep workers running and execute jobs sent (one per line) by clients connected to args.socket. '''
+    task_queue, done_queue, workers = await _setup_workers(args)
+    job_ids = itertools.count()
+    pending = {}  # job_id -> (result queue of client, job_id within client)
+
+    async def dispatch():
+        # Forward results to the client which sent the job
+        while True:
+            for result in await done_queue.get():
+                client = pending.pop(result.job_id, None)
+                if client is None:
+                    continue  # client is gone already
+                client_results, result.job_id = client
+                client_results.put_nowait(result)
+
+    def drop_jobs(client_results):
+        # Forget all jobs of a client, and do not even start those still queued.
+        queued = [task_queue.get_nowait() for i in range(task_queue.qsize())]
+        for job_id, job in queued:
+            if pending.get(job_id, (None, None))[0] is not client_results:
+                task_queue.put_nowait((job_id, job))
+        for job_id in [j for j, (results, _) in pending.items() if results is client_results]:
+            del pending[job_id]
+
+    async def handle_client(reader, writer):
+        client_results = asyncio.Queue()  # results of this client's jobs, None once it sent all jobs
+        num_jobs = 0
+
+        async def receive_jobs():
+            nonlocal num_jobs
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                job = line.decode().strip()
+                if not job:
+                    continue
+                job_id = next(job_ids)
+                pending[job_id] = (client_results, num_jobs)
+                await task_queue.put((job_id, job))
+                num_jobs += 1
+            client_results.put_nowait(None)
+
+        async def send_reports(options):
+            num_reported, received_all = 0, False
+            while not received_all or num_reported < num_jobs:
+                result = await client_results.get()
+                if result is None:
+                    received_all = True
+                    continue
+                writer.write(_format_report(result, options['suppress_console']).encode())
+                await writer.drain()
+                num_reported += 1
+
+        tasks = []
+        try:
+            options = json.loads(await reader.readline())  # header, see _submit
+            # Report results as soon as they are available, even while the client still sends jobs.
+            tasks = [asyncio.ensure_future(receive_jobs()), asyncio.ensure_future(send_reports(options))]
+            await asyncio.gather(*tasks)
+        except (ConnectionError, ValueError):
+            pass  # client vanished (or is no dojobs client)
+        except asyncio.CancelledError:
+            pass  # server is stopped
+        finally:
+            for task in tasks:
+                task.cancel()
+            drop_jobs(client_results)
+            writer.close()
+
+    server = await asyncio.start_unix_server(handle_client, path=args.socket)
+    try:
+        async with server:
+            await asyncio.gather(server.serve_forever(), dispatch(), *workers)
+    finally:
+        with contextlib.suppress(FileNotFoundError):  # removed by the server itself since Python 3.13
+            os.unlink(args.socket)
+
+
+async def _submit(args):
+    ''' Send all jobs of args.jobfile to the server at args.socket and print the returned reports. '''
+    reader, writer = await asyncio.open_unix_connection(args.socket)
 
-    # Get and report results
-    for i in range(num_jobs):
-        report(suppress_console=args.suppress_console, **done_queue.get())
+    async def send_jobs():
+        writer.write(json.dumps({'suppress_console': args.suppress_console}).encode() + b'\n')  # header of options
+        async for job in _read_jobs(args.jobfile):
+            writer.write(job.encode() + b'\n')
+            await writer.drain()  # Returns right away, unless the server is behind.
+        writer.write_eof()
 
-    # Tell child processes to stop
-    for i in range(num_processes):
-        task_queue.put('STOP')
+    # Print reports while still sending jobs; the server closes the connection once all jobs are reported.
+    sending = asyncio.ensure_future(send_jobs())
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            sys.stdout.buffer.write(data)
+            sys.stdout.flush()
+    finally:
+        sending.cancel()
+        writer.close()
 
-# TODO: How does STOP work? How does iter work?
 # TODO: Documentation
 
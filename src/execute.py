@@ -1,6 +1,12 @@
+import asyncio
+import contextlib
 import logging
-import pipes
+import os
+import shlex
+import signal
 import subprocess
+import sys
+import time
 import enum
 from datetime import datetime
 
@@ -9,8 +15,8 @@ def enable_debug_logging():
     logging.getLogger().setLevel(logging.DEBUG)
 
 
-def ssh_prefix(host):
-    return ['ssh', '-o', 'StrictHostKeyChecking no', host]
+def ssh_prefix(host, *options):
+    return ['ssh', '-o', 'StrictHostKeyChecking no', *options, host]
 
 
 def rsync_prefix():
@@ -20,12 +26,35 @@ def rsync_prefix():
             '-e', 'ssh -o "StrictHostKeyChecking no"']  # accept anything, just continue
 
 
+# Read cmd output in chunks of (at most) this many bytes.
+_READ_CHUNK_SIZE = 65536
+
+
+def _no_printing(line):
+    pass
+
+
+def _decode_lines(data):
+    ''' Split data (without final newline) into lines, ending them like universal newlines do. '''
+    text = data.decode(errors='replace').replace('\r\n', '\n')
+    if text.endswith('\r'):  # the '\n' following it was split off already
+        text = text[:-1]
+    return text.split('\n')
+
+
+async def _kill(proc):
+    ''' Kill proc along with all processes it started (ie. its process group) and wait for proc to be gone. '''
+    with contextlib.suppress(ProcessLookupError):  # everything may have exited already
+        os.killpg(proc.pid, signal.SIGKILL)
+    await proc.wait()
+
+
 ExecutePrintMode = enum.Enum('ExecutePrintMode',
                              ['with_timestamps_and_prefix', 'with_prefix', 'pure_lines', 'no_printing'])
 
 
-def execute(input_cmd, show_errors=False, cwd=None, print_prefix=None, timeout=None, print_mode=None):
-    ''' Execute given cmd (list of strings), ignore errors and return the cmd output.
+async def execute(input_cmd, show_errors=False, cwd=None, print_prefix=None, timeout=None, print_mode=None):
+    ''' Execute given cmd (list of strings), ignore errors and return the cmd output. Needs to be awaited.
         Note: The cmd will not be run inside a shell, ie. shell features (ie. redirection) are not available.
        :param input_cmd: List of strings forming the cmd to be executed.
        :param show_errors: Toggle whether errors of the executed cmd are suppressed.
@@ -35,17 +64,6 @@ def execute(input_cmd, show_errors=False, cwd=None, print_prefix=None, timeout=N
        :return: tuple of return code and list of output lines. The list is returned even if the output was also printed.
     '''
 
-    def print_line_with_timestamp(line):
-        n = datetime.now().time()
-        print('[{:s} {:02d}:{:02d}:{:02d}] {:s}'.format(print_prefix, n.hour, n.minute, n.second, line), end='')
-
-    available_printers = {
-        ExecutePrintMode.with_timestamps_and_prefix: lambda l: print_line_with_timestamp(line),
-        ExecutePrintMode.with_prefix: lambda l: print('[{:s}] {:s}'.format(print_prefix, line), end=''),
-        ExecutePrintMode.pure_lines: lambda l: print(str(l), end=''),
-        ExecutePrintMode.no_printing: lambda l: None
-    }
-
     # For historical reasons
     if print_prefix is not None and print_mode is None:
         print_mode = ExecutePrintMode.with_timestamps_and_prefix
@@ -57,25 +75,85 @@ def execute(input_cmd, show_errors=False, cwd=None, print_prefix=None, timeout=N
         print_mode = ExecutePrintMode.pure_lines
     assert print_mode is not None, 'Need a valid ExecutePrintMode at this point!'
 
+    if print_mode is ExecutePrintMode.with_timestamps_and_prefix:
+        timestamp_second, timestamp_prefix = None, ''  # Prefix is only rebuilt once the second changes
+
+        def printer(line):
+            nonlocal timestamp_second, timestamp_prefix
+            second = int(time.time())
+            if second != timestamp_second:
+                n = datetime.now().time()
+                timestamp_second = second
+                timestamp_prefix = '[{:s} {:02d}:{:02d}:{:02d}] '.format(print_prefix, n.hour, n.minute, n.second)
+            sys.stdout.write(timestamp_prefix + line)
+    elif print_mode is ExecutePrintMode.with_prefix:
+        prefix = '[{:s}] '.format(print_prefix)
+
+        def printer(line):
+            sys.stdout.write(prefix + line)
+    elif print_mode is ExecutePrintMode.pure_lines:
+        printer = sys.stdout.write
+    else:
+        printer = _no_printing
+
     cmd = input_cmd
-    logging.debug('Ex : ' + ' '.join([c if c[0] == '-' else pipes.quote(c) for c in cmd]))
+    if logging.getLogger().isEnabledFor(logging.DEBUG):  # Skip quoting unless it is actually logged
+        logging.debug('Ex : ' + ' '.join(c if c[:1] == '-' else shlex.quote(c) for c in cmd))
 
+    proc = None
+    read_file, output = None, None  # reading end of the stdout pipe of proc, and the transport reading it
     try:
         stderr = None if show_errors else subprocess.DEVNULL
-        # return subprocess.check_output(cmd, universal_newlines=True, stderr=stderr, cwd=cwd, timeout=timeout).splitlines()
-        printer = available_printers[print_mode]
-        proc = subprocess.Popen(cmd, universal_newlines=True, stdout=subprocess.PIPE, stderr=stderr, bufsize=1, cwd=cwd)
+        # Use a pipe of our own rather than stdout=PIPE, as only then waiting for proc does not also wait for all its
+        # children to close stdout, eg. after proc was killed on timeout.
+        read_fd, write_fd = os.pipe()
+        read_file = open(read_fd, 'rb', buffering=0)
+        try:
+            # In a session of its own, such that proc can be killed along with anything it started, see _kill
+            proc = await asyncio.create_subprocess_exec(*cmd, stdin=subprocess.DEVNULL, stdout=write_fd, stderr=stderr,
+                                                        cwd=cwd, start_new_session=True)
+        finally:
+            os.close(write_fd)
+        stdout = asyncio.StreamReader()
+        output, _ = await asyncio.get_running_loop().connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(stdout), read_file)
         str_data = []
-        for line in proc.stdout:
-            str_data.append(str(line).strip('\n'))
-            printer(line)
-        proc.communicate(timeout=timeout)  # Should do just nothing, but ensures proc is actually done
+
+        async def read_until_done():
+            pending = []  # chunks of output following the last complete line; only joined once that line is complete
+            while True:
+                chunk = await stdout.read(_READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                newline_at = chunk.rfind(b'\n')
+                if newline_at < 0:
+                    pending.append(chunk)
+                    continue
+                pending.append(chunk[:newline_at])
+                for line in _decode_lines(b''.join(pending)):  # decode all complete lines of this chunk at once
+                    str_data.append(line)
+                    printer(line + '\n')
+                pending = [chunk[newline_at + 1:]]
+            pending = b''.join(pending)
+            if pending:  # output may not end with a newline
+                line, = _decode_lines(pending)
+                str_data.append(line)
+                printer(line)
+            await proc.wait()
+
+        await asyncio.wait_for(read_until_done(), timeout=timeout)  # timeout covers the entire cmd
         return proc.returncode, str_data
-    except subprocess.CalledProcessError as xcp:
-        return xcp.returncode, xcp.output.splitlines()
     except FileNotFoundError:
         return 1, []  # specified cwd might not exist (locally)
-    except subprocess.TimeoutExpired:
-        proc.kill()
-        proc.communicate()
+    except asyncio.CancelledError:
+        if proc is not None:
+            await _kill(proc)  # do not leave the cmd running unattended
+        raise
+    except asyncio.TimeoutError:
+        await _kill(proc)  # proc itself may be done, while something it started still holds stdout
         return 2, []  # just return nothing
+    finally:
+        if output is not None:
+            output.close()
+        elif read_file is not None:
+            read_file.close()